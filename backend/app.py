@@ -1,8 +1,20 @@
 import os
 import sqlite3
 import json
+import re
+import orjson
+import zstandard
+import time
+import threading
+import hashlib
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing_extensions import TypedDict
 import fitz  # PyMuPDF
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from flask_cors import CORS
@@ -13,13 +25,37 @@ load_dotenv()
 # --- CONFIGURATION ---
 UPLOAD_FOLDER = 'uploads'
 DATABASE = 'documents.db'
+# Applied to every new connection: WAL lets readers and the writer proceed
+# concurrently, and busy_timeout waits for locks instead of failing.
+# WAL is persisted in the database file, so only the writer switches to it.
+SQLITE_WRITER_PRAGMAS = ("journal_mode=WAL",)
+SQLITE_PRAGMAS = (
+    "synchronous=NORMAL", "busy_timeout=5000",
+    "cache_size=-20000", "temp_store=memory", "foreign_keys=ON"
+)
 ALLOWED_EXTENSIONS = {'pdf'}
+# Only this much document text is ever extracted, stored, or sent to Gemini
+PROMPT_TEXT_LIMIT = 8000
+# Page size of the document list
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+ZSTD_LEVEL = 3
 
 # This line is now changed to securely get the Google API key.
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
 # --- FLASK APP SETUP ---
+class ORJSONProvider(JSONProvider):
+    """Serializes jsonify() responses with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Add a check to ensure the API key was loaded
@@ -31,29 +67,138 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # Ensure the upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Background pool that archives uploaded PDFs after the response is built.
+# Gemini calls and PDF extraction run on the request thread and are not
+# limited by it; two workers are enough to keep up with local disk writes.
+archive_executor = ThreadPoolExecutor(max_workers=2)
+
 
 # --- DATABASE SETUP ---
-def get_db():
-    """Opens a new database connection if there is none yet for the current application context."""
-    if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE, detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
-@app.teardown_appcontext
-def close_connection(exception):
-    """Closes the database again at the end of the request."""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+# Connections are pooled across requests: a single writer, so writes never
+# hit SQLITE_BUSY, and several read-only connections. A None entry is a free
+# slot whose connection is opened on first use. Connections are checked out
+# for one block of queries at a time, never across a Gemini call.
+DB_POOL_TIMEOUT = 5  # seconds to wait for a free connection
+WRITE_POOL = queue.Queue(maxsize=1)
+READ_POOL = queue.Queue(maxsize=(os.cpu_count() or 1) * 2)
+for pool in (WRITE_POOL, READ_POOL):
+    while not pool.full():
+        pool.put(None)
+
+def connect_db(readonly):
+    """Opens a tuned database connection, either read-only or in autocommit mode for writing."""
+    # Pooled connections move between request threads, but are
+    # only ever used by one of them at a time.
+    if readonly:
+        db = sqlite3.connect(f'file:{DATABASE}?mode=ro', uri=True,
+                             detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    else:
+        db = sqlite3.connect(DATABASE, detect_types=sqlite3.PARSE_DECLTYPES,
+                             check_same_thread=False, isolation_level=None)
+        for pragma in SQLITE_WRITER_PRAGMAS:
+            db.execute(f"PRAGMA {pragma}")
+    db.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        db.execute(f"PRAGMA {pragma}")
+    return db
+
+class DatabaseBusyError(Exception):
+    """Raised when no pooled database connection frees up in time."""
+
+@contextmanager
+def db_connection(readonly=True):
+    """Checks out a pooled database connection for the duration of a with block."""
+    pool = READ_POOL if readonly else WRITE_POOL
+    try:
+        db = pool.get(timeout=DB_POOL_TIMEOUT)
+    except queue.Empty:
+        raise DatabaseBusyError("No database connection available") from None
+    try:
+        if db is None:
+            db = connect_db(readonly)
+        yield db
+    finally:
+        if db is not None and db.in_transaction:
+            db.rollback()
+        pool.put(db)
+
+@app.errorhandler(DatabaseBusyError)
+def database_busy(e):
+    """Tells the client to retry when the database pool is exhausted."""
+    return jsonify({"error": "The server is busy, please retry"}), 503
 
 def init_db():
     """Initializes the database schema."""
-    with app.app_context():
-        db = get_db()
+    with app.app_context(), db_connection(readonly=False) as db:
         with app.open_resource('schema.sql', mode='r') as f:
             db.cursor().executescript(f.read())
-        db.commit()
+
+def table_columns(db, table):
+    """Returns the column names of a table, or an empty set if it doesn't exist."""
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+
+def migrate_db():
+    """Upgrades a database created by an older schema.sql in place, keeping its rows."""
+    with app.app_context(), db_connection(readonly=False) as db:
+        # documents is rebuilt while other tables still reference it
+        db.execute('PRAGMA foreign_keys=OFF')
+        try:
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS document_content ('
+                    'doc_id INTEGER PRIMARY KEY, content BLOB NOT NULL, '
+                    'FOREIGN KEY (doc_id) REFERENCES documents (id))'
+                )
+                columns = table_columns(db, 'documents')
+                if 'content' in columns:
+                    # Document text moves out of 'documents' into its own table
+                    for row in db.execute('SELECT id, content FROM documents').fetchall():
+                        db.execute(
+                            'INSERT OR IGNORE INTO document_content (doc_id, content) VALUES (?, ?)',
+                            (row['id'], compress(row['content'][:PROMPT_TEXT_LIMIT].encode()))
+                        )
+                if columns != {'id', 'filename', 'file_hash', 'uploaded_at'}:
+                    # SQLite can't add a UNIQUE column or drop one in place, so copy the table
+                    file_hash = 'file_hash' if 'file_hash' in columns else 'NULL'
+                    db.execute(
+                        'CREATE TABLE documents_new ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL, file_hash TEXT UNIQUE, '
+                        'uploaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+                    )
+                    db.execute(
+                        f'INSERT INTO documents_new (id, filename, file_hash, uploaded_at) '
+                        f'SELECT id, filename, {file_hash}, uploaded_at FROM documents'
+                    )
+                    db.execute('DROP TABLE documents')
+                    db.execute('ALTER TABLE documents_new RENAME TO documents')
+
+                # Text stored before compression was introduced
+                for row in db.execute("SELECT doc_id, content FROM document_content WHERE typeof(content) = 'text'").fetchall():
+                    db.execute('UPDATE document_content SET content = ? WHERE doc_id = ?',
+                               (compress(row['content'].encode()), row['doc_id']))
+
+                columns = table_columns(db, 'analysis_results')
+                if 'analysis_json' not in columns:
+                    db.execute('ALTER TABLE analysis_results ADD COLUMN analysis_json BLOB')
+                if 'etag' not in columns:
+                    db.execute('ALTER TABLE analysis_results ADD COLUMN etag TEXT')
+                # Analysis JSON stored before compression, some of it without an ETag
+                for row in db.execute("SELECT id, analysis_json FROM analysis_results WHERE typeof(analysis_json) = 'text'").fetchall():
+                    analysis_json = row['analysis_json'].encode()
+                    db.execute('UPDATE analysis_results SET analysis_json = ?, etag = ? WHERE id = ?',
+                               (compress(analysis_json), analysis_etag(analysis_json), row['id']))
+
+                index_columns = [row['name'] for row in db.execute('PRAGMA index_info(idx_results_doc_id)')]
+                if index_columns != ['doc_id', 'etag']:
+                    db.execute('DROP INDEX IF EXISTS idx_results_doc_id')
+                    db.execute('CREATE INDEX idx_results_doc_id ON analysis_results (doc_id, etag)')
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache ('
+                    'key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at INTEGER NOT NULL)'
+                )
+        finally:
+            db.execute('PRAGMA foreign_keys=ON')
 
 # Command to initialize DB: flask --app app init-db
 @app.cli.command('init-db')
@@ -62,23 +207,57 @@ def init_db_command():
     init_db()
     print('Initialized the database.')
 
+# Command to upgrade an existing DB: flask --app app migrate-db
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Upgrade the tables to the current schema, keeping existing data."""
+    migrate_db()
+    print('Migrated the database.')
+
 
 # --- HELPER FUNCTIONS ---
 def allowed_file(filename):
     """Checks if a file's extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf(filepath):
-    """Extracts text content from a PDF file."""
+def analysis_etag(analysis_json):
+    """Computes the ETag of an analysis from its uncompressed JSON bytes."""
+    return hashlib.blake2b(analysis_json, digest_size=8).hexdigest()
+
+# Document text and analysis JSON are stored zstd-compressed
+def compress(data):
+    """Compresses bytes for storage in a BLOB column."""
+    return zstandard.compress(data, ZSTD_LEVEL)
+
+def decompress(blob):
+    """Decompresses a BLOB written by compress()."""
+    return zstandard.decompress(blob)
+
+def archive_upload(pdf_bytes, filepath):
+    """Keeps a copy of an uploaded PDF in the upload folder."""
     try:
-        doc = fitz.open(filepath)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+        with open(filepath, 'wb') as out:
+            out.write(pdf_bytes)
+    except OSError as e:
+        print(f"Error archiving upload to {filepath}: {e}")
+
+def extract_text_from_pdf(pdf_bytes, max_chars=PROMPT_TEXT_LIMIT):
+    """Extracts text content from PDF bytes, stopping at the first page that reaches max_chars."""
+    try:
+        parts = []
+        total_len = 0
+        # Pages are read one at a time: PyMuPDF holds the GIL and isn't
+        # thread-safe, and only the first few pages are needed anyway.
+        with fitz.open(stream=pdf_bytes, filetype='pdf') as doc:
+            for page in doc:
+                page_text = page.get_text("text", sort=True)
+                parts.append(page_text)
+                total_len += len(page_text)
+                if total_len >= max_chars:
+                    break
+        return "".join(parts)
     except Exception as e:
-        print(f"Error extracting text from {filepath}: {e}")
+        print(f"Error extracting text from PDF: {e}")
         return None
 
 # --- LLM INTEGRATION (GOOGLE GEMINI) ---
@@ -126,101 +305,275 @@ FIELD_DESCRIPTIONS = {
     }
 }
 
-# Set up the generation configuration for JSON output
-json_generation_config = genai.GenerationConfig(response_mime_type="application/json")
+# Keys every completeness analysis is expected to carry
+ANALYSIS_KEYS = ["missing_fields", "incomplete_fields", "recommendations",
+                 "risk_factors", "compliance_notes", "completeness_score",
+                 "critical_issues"]
+
+class Analysis(TypedDict):
+    """Structured output schema for a document completeness analysis."""
+    missing_fields: list[str]
+    incomplete_fields: list[str]
+    recommendations: list[str]
+    risk_factors: list[str]
+    compliance_notes: list[str]
+    completeness_score: float
+    critical_issues: list[str]
+
+class DocumentAnalysis(Analysis):
+    """Structured output schema for the combined classification and analysis call."""
+    document_type: str
+    confidence_score: float
+
+# Set up the generation configuration for structured JSON output
+analysis_generation_config = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=Analysis
+)
+classify_and_analyze_config = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=DocumentAnalysis
+)
+
+# Using a modern, fast, and capable Gemini model
+GEMINI_MODEL_NAME = 'gemini-1.5-flash-latest'
+
+# --- STATIC PROMPTS ---
+# Each prompt is split into static instructions and a field schema block, so
+# that only the document text changes between requests.
+ANALYSIS_ASPECTS = """
+Analyze the document for these aspects:
+1. Present/Missing Fields
+2. Quality and Completeness
+3. Legal Compliance
+4. Potential Risks
+5. Best Practices
+"""
+
+ANALYSIS_RESPONSE_KEYS = """
+"missing_fields": List of missing required fields
+"incomplete_fields": List of fields that are present but need improvement
+"recommendations": List of specific, actionable recommendations for each issue
+"risk_factors": List of potential risks or concerns identified
+"compliance_notes": List of compliance-related observations
+"completeness_score": Number between 0-100 indicating overall document quality
+"critical_issues": List of high-priority issues that need immediate attention
+"""
+
+ANALYSIS_CLOSING = "Provide detailed, professional analysis focusing on both technical completeness and practical business implications."
+
+# Key of the combined classification and analysis prompt in STATIC_PROMPTS
+CLASSIFY_PROMPT = "Classify"
+
+STATIC_PROMPTS = {
+    CLASSIFY_PROMPT: (
+        "You are an expert document analyst.\n"
+        "Classify the type of the document text you are given and provide a detailed assessment of its completeness.\n"
+        'The possible types are "Contract", "Invoice", "Report", or "Other".\n'
+        "Analyze the document against the required fields of its type.\n"
+        + ANALYSIS_ASPECTS +
+        "\nReturn your response as a JSON object with these keys:\n"
+        '"document_type": One of the possible types\n'
+        '"confidence_score": Float between 0.0 and 1.0 for the classification'
+        + ANALYSIS_RESPONSE_KEYS + "\n" + ANALYSIS_CLOSING,
+        "Required fields for each document type:\n" + json.dumps(FIELD_DESCRIPTIONS, indent=2)
+    ),
+    **{
+        doc_type: (
+            f"You are an expert document analyst specializing in {doc_type.lower()} analysis.\n"
+            "Analyze the document text you are given thoroughly and provide a detailed assessment.\n"
+            + ANALYSIS_ASPECTS +
+            "\nReturn your response as a JSON object with these keys:"
+            + ANALYSIS_RESPONSE_KEYS + "\n" + ANALYSIS_CLOSING,
+            f"Required fields for a {doc_type}:\n" + json.dumps(field_desc, indent=2)
+        )
+        for doc_type, field_desc in FIELD_DESCRIPTIONS.items()
+    }
+}
+
+# Generation config for each prompt, bound to its models once at startup
+PROMPT_GENERATION_CONFIGS = {
+    key: classify_and_analyze_config if key == CLASSIFY_PROMPT else analysis_generation_config
+    for key in STATIC_PROMPTS
+}
+
+# Models for each prompt, shared across requests
+PROMPT_MODELS = {
+    key: genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=config)
+    for key, config in PROMPT_GENERATION_CONFIGS.items()
+}
+
+# Each prompt is sent as one prefix string ahead of the document text.
+# Gemini context caching needs at least 32,768 tokens of content, far more
+# than these prompts, so they are not cached on the Gemini side.
+PROMPT_PREFIXES = {
+    key: f"{instructions}\n\n{schema_block}\n\n"
+    for key, (instructions, schema_block) in STATIC_PROMPTS.items()
+}
+DOCUMENT_PREFIX = "Document Text:\n---\n"
+DOCUMENT_SUFFIX = "\n---"
+
+# --- LLM RESPONSE CACHE ---
+# Gemini responses keyed by document text and prompt, kept in memory and
+# persisted to the llm_cache table so restarts don't start cold. The table is
+# best-effort: if it can't be read or written, Gemini is simply asked again.
+LLM_CACHE_MAXSIZE = 2048
+LLM_CACHE_TTL = 24 * 60 * 60  # seconds
+
+llm_cache = OrderedDict()  # key -> (created_at, response JSON string)
+llm_cache_lock = threading.Lock()
+
+def llm_cache_key(text, prompt_key):
+    """Builds the cache key for a document text sent with the prompt for prompt_key."""
+    return hashlib.blake2b(text[:PROMPT_TEXT_LIMIT].encode(), digest_size=16).hexdigest() + ':' + prompt_key
+
+def remember_response(key, created_at, response):
+    """Stores a response in the in-memory cache, evicting the least recently used entries."""
+    with llm_cache_lock:
+        llm_cache[key] = (created_at, response)
+        llm_cache.move_to_end(key)
+        while len(llm_cache) > LLM_CACHE_MAXSIZE:
+            llm_cache.popitem(last=False)
+
+def get_cached_response(key):
+    """Returns the cached response JSON string for key, or None if missing or expired."""
+    now = int(time.time())
+    with llm_cache_lock:
+        entry = llm_cache.get(key)
+        if entry is not None and now - entry[0] < LLM_CACHE_TTL:
+            llm_cache.move_to_end(key)
+            return entry[1]
+
+    try:
+        with db_connection() as db:
+            row = db.execute('SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+    except (sqlite3.Error, DatabaseBusyError) as e:
+        print(f"Could not read the LLM cache: {e}")
+        return None
+    if row is None or now - row['created_at'] >= LLM_CACHE_TTL:
+        return None
+    remember_response(key, row['created_at'], row['response'])
+    return row['response']
+
+def cache_response(key, response):
+    """Stores a response JSON string in memory and in the llm_cache table, pruning expired rows."""
+    created_at = int(time.time())
+    remember_response(key, created_at, response)
+    try:
+        with db_connection(readonly=False) as db, db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM llm_cache WHERE created_at <= ?', (created_at - LLM_CACHE_TTL,))
+            db.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, ?)',
+                (key, response, created_at)
+            )
+    except (sqlite3.Error, DatabaseBusyError) as e:
+        print(f"Could not write the LLM cache: {e}")
+
+def generate_json(prompt_key, text, use_cache=True):
+    """Sends the document text to Gemini after the static prompt for prompt_key and decodes the JSON response."""
+    key = llm_cache_key(text, prompt_key)
+    cached = get_cached_response(key) if use_cache else None
+    if cached is not None:
+        return orjson.loads(cached)
+
+    document = DOCUMENT_PREFIX + text[:PROMPT_TEXT_LIMIT] + DOCUMENT_SUFFIX
+    response = PROMPT_MODELS[prompt_key].generate_content(PROMPT_PREFIXES[prompt_key] + document)
+    result = orjson.loads(response.text)
+    cache_response(key, response.text)
+    return result
+
+def fill_analysis_defaults(result):
+    """Ensure all expected analysis keys are present in a Gemini response."""
+    for key in ANALYSIS_KEYS:
+        if key not in result:
+            result[key] = [] if key != "completeness_score" else 0
+    return result
+
+# Keywords that identify common document types without asking Gemini
+CLASSIFIER_PATTERNS = {
+    "Invoice": [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\binvoice\s*(?:#|no\b|number\b)", r"\bbill(?:ed)?\s+to\b", r"\bamount\s+due\b",
+        r"\bsub-?total\b", r"\bdue\s+date\b", r"\bqty\b|\bquantity\b", r"\bunit\s+price\b"
+    )],
+    "Contract": [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\bthis\s+(?:agreement|contract)\b", r"\beffective\s+date\b", r"\bgoverning\s+law\b",
+        r"\bwhereas\b", r"\bin\s+witness\s+whereof\b", r"\bterminat(?:e|ion)\b", r"\bindemnif"
+    )]
+}
+# Keyword classifications below this confidence are left to Gemini
+FAST_CLASSIFY_THRESHOLD = 0.8
+
+def fast_classify(text):
+    """Classifies a document from keyword matches, returning (doc_type, confidence)."""
+    sample = text[:PROMPT_TEXT_LIMIT]
+    hits = {
+        doc_type: sum(1 for pattern in patterns if pattern.search(sample))
+        for doc_type, patterns in CLASSIFIER_PATTERNS.items()
+    }
+    doc_type = max(hits, key=hits.get)
+    if hits[doc_type] == 0:
+        return "Other", 0.0
+
+    # Share of all keyword hits, scaled down until at least three distinct keywords match
+    confidence = hits[doc_type] / sum(hits.values()) * min(hits[doc_type] / 3, 1.0)
+    return doc_type, round(confidence, 2)
+
+def analysis_error():
+    """Placeholder classification and analysis for a document Gemini could not analyze."""
+    return ({"document_type": "Error", "confidence_score": 0.0},
+            {"missing_fields": ["Analysis Error"], "recommendations": ["Could not perform analysis due to an API error."]})
 
-def classify_document(text):
-    """Uses Google Gemini to classify the document type."""
+def classify_and_analyze(text, use_cache=True):
+    """Uses a single Google Gemini call to classify the document and analyze its completeness."""
     try:
-        # Using a modern, fast, and capable Gemini model
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        prompt = f"""
-        Analyze the following document text and classify its type.
-        The possible types are "Contract", "Invoice", "Report", or "Other".
-        Return your response as a JSON object with two keys: "document_type" (string) and "confidence_score" (float between 0.0 and 1.0).
-
-        Document Text:
-        ---
-        {text[:8000]}
-        ---
-        """
-        response = model.generate_content(prompt, generation_config=json_generation_config)
-        result = json.loads(response.text)
-        return result
+        result = generate_json(CLASSIFY_PROMPT, text, use_cache)
+
+        classification = {
+            "document_type": result.pop("document_type", "Other"),
+            "confidence_score": result.pop("confidence_score", 0.0)
+        }
+        # Only Contracts and Invoices have a defined set of required fields
+        if classification["document_type"] not in REQUIRED_FIELDS:
+            return classification, {"missing_fields": [], "recommendations": ["Document type does not have a defined set of required fields."]}
+
+        return classification, fill_analysis_defaults(result)
     except Exception as e:
-        print(f"Error in Gemini classification: {e}")
-        return {"document_type": "Error", "confidence_score": 0.0}
+        print(f"Error in Gemini classification and analysis: {e}")
+        return analysis_error()
+
+def analyze_missing_fields(text, doc_type, use_cache=True):
+    """Uses Google Gemini to find missing fields and analyze document completeness.
 
-def analyze_missing_fields(text, doc_type):
-    """Uses Google Gemini to find missing fields and analyze document completeness."""
+    Returns None if the Gemini call fails.
+    """
     if doc_type not in REQUIRED_FIELDS:
         return {"missing_fields": [], "recommendations": ["Document type does not have a defined set of required fields."]}
 
-    required = REQUIRED_FIELDS[doc_type]
-    field_desc = FIELD_DESCRIPTIONS[doc_type]
-    
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        prompt = f"""
-        You are an expert document analyst specializing in {doc_type.lower()} analysis. 
-        Analyze the following document text thoroughly and provide a detailed assessment.
-
-        Required fields for a {doc_type}:
-        {json.dumps(field_desc, indent=2)}
-
-        Analyze the document for these aspects:
-        1. Present/Missing Fields
-        2. Quality and Completeness
-        3. Legal Compliance
-        4. Potential Risks
-        5. Best Practices
-
-        Return your response as a JSON object with these keys:
-        1. "missing_fields": List of missing required fields
-        2. "incomplete_fields": List of fields that are present but need improvement
-        3. "recommendations": List of specific, actionable recommendations for each issue
-        4. "risk_factors": List of potential risks or concerns identified
-        5. "compliance_notes": List of compliance-related observations
-        6. "completeness_score": Number between 0-100 indicating overall document quality
-        7. "critical_issues": List of high-priority issues that need immediate attention
-
-        Document Text:
-        ---
-        {text[:8000]}
-        ---
-
-        Provide detailed, professional analysis focusing on both technical completeness and practical business implications.
-        """
-        response = model.generate_content(prompt, generation_config=json_generation_config)
-        result = json.loads(response.text)
-        
+        result = generate_json(doc_type, text, use_cache)
+
         # Ensure all expected fields are present in the response
-        required_keys = ["missing_fields", "incomplete_fields", "recommendations", 
-                        "risk_factors", "compliance_notes", "completeness_score", 
-                        "critical_issues"]
-        for key in required_keys:
-            if key not in result:
-                result[key] = [] if key != "completeness_score" else 0
-                
-        return result
+        return fill_analysis_defaults(result)
     except Exception as e:
         print(f"Error in Gemini missing fields analysis: {e}")
-        return {"missing_fields": ["Analysis Error"], "recommendations": ["Could not perform analysis due to an API error."]}
+        return None
 
 # --- API ROUTES (No changes needed below this line) ---
 @app.route('/documents', methods=['GET'])
 def get_documents():
-    """Get a list of all uploaded documents."""
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        'SELECT d.id as document_id, d.filename, r.doc_type, r.confidence '
-        'FROM documents d LEFT JOIN analysis_results r ON d.id = r.doc_id '
-        'ORDER BY d.id DESC'
-    )
-    documents = cursor.fetchall()
+    """Get a page of uploaded documents, newest first (?limit=&offset=)."""
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    with db_connection() as db:
+        documents = db.execute(
+            'SELECT d.id as document_id, d.filename, r.doc_type, r.confidence '
+            'FROM documents d LEFT JOIN analysis_results r ON d.id = r.doc_id '
+            'ORDER BY d.id DESC '
+            'LIMIT ? OFFSET ?',
+            (limit, offset)
+        ).fetchall()
     
     return jsonify([{
         'document_id': doc['document_id'],
@@ -231,6 +584,38 @@ def get_documents():
         }
     } for doc in documents]), 200
 
+@app.route('/cache/clear', methods=['POST'])
+def clear_llm_cache():
+    """Drop all cached Gemini responses."""
+    with llm_cache_lock:
+        llm_cache.clear()
+    with db_connection(readonly=False) as db:
+        db.execute('DELETE FROM llm_cache')
+    return jsonify({"message": "LLM response cache cleared"}), 200
+
+def find_analyzed_document(file_hash):
+    """Returns the upload response for an already analyzed file, or None if it is new."""
+    with db_connection() as db:
+        result = db.execute(
+            'SELECT d.id, d.filename, r.doc_type, r.confidence, r.analysis_json '
+            'FROM documents d JOIN analysis_results r ON d.id = r.doc_id '
+            "WHERE d.file_hash = ? AND r.doc_type != 'Error'",
+            (file_hash,)
+        ).fetchone()
+    if result is None:
+        return None
+
+    return {
+        "message": "File was already uploaded and analyzed",
+        "document_id": result['id'],
+        "filename": result['filename'],
+        "classification": {
+            "document_type": result['doc_type'],
+            "confidence_score": result['confidence']
+        },
+        "analysis": orjson.loads(decompress(result['analysis_json']))
+    }
+
 @app.route('/upload', methods=['POST'])
 def upload_and_analyze_document():
     if 'file' not in request.files:
@@ -242,75 +627,138 @@ def upload_and_analyze_document():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        pdf_bytes = file.read()
+        file_hash = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+        # Identical files skip extraction and analysis entirely
+        existing = find_analyzed_document(file_hash)
+        if existing is not None:
+            return jsonify(existing), 200
 
-        text_content = extract_text_from_pdf(filepath)
+        # Text is extracted straight from memory, the PDF is only archived
+        text_content = extract_text_from_pdf(pdf_bytes)
         if text_content is None:
             return jsonify({"error": "Could not extract text from PDF"}), 500
 
-        db = get_db()
-        cursor = db.cursor()
-
-        cursor.execute(
-            'INSERT INTO documents (filename, content) VALUES (?, ?)',
-            (filename, text_content)
-        )
-        doc_id = cursor.lastrowid
-        db.commit()
-
-        classification_result = classify_document(text_content)
+        doc_type, confidence = fast_classify(text_content)
+        if confidence >= FAST_CLASSIFY_THRESHOLD:
+            # Obvious document types only need the smaller analyst prompt
+            classification_result = {"document_type": doc_type, "confidence_score": confidence}
+            analysis_result = analyze_missing_fields(text_content, doc_type)
+            if analysis_result is None:
+                classification_result, analysis_result = analysis_error()
+        else:
+            classification_result, analysis_result = classify_and_analyze(text_content)
         doc_type = classification_result.get("document_type", "Other")
         confidence = classification_result.get("confidence_score", 0.0)
 
-        analysis_result = analyze_missing_fields(text_content, doc_type)
         missing_fields = analysis_result.get("missing_fields", [])
         recommendations = analysis_result.get("recommendations", [])
+        analysis = {
+            "missing_fields": missing_fields,
+            "incomplete_fields": analysis_result.get("incomplete_fields", []),
+            "recommendations": recommendations,
+            "risk_factors": analysis_result.get("risk_factors", []),
+            "compliance_notes": analysis_result.get("compliance_notes", []),
+            "completeness_score": analysis_result.get("completeness_score", 0),
+            "critical_issues": analysis_result.get("critical_issues", [])
+        }
 
-        cursor.execute(
-            'INSERT INTO analysis_results (doc_id, doc_type, confidence, missing_fields, recommendations) VALUES (?, ?, ?, ?, ?)',
-            (doc_id, doc_type, confidence, json.dumps(missing_fields), json.dumps(recommendations))
-        )
-        db.commit()
+        # Write both rows in one transaction (a single commit) once the Gemini
+        # call is done, so the single writer is never held across network I/O.
+        # Failed analyses are stored without a hash so a re-upload tries again.
+        analysis_json = orjson.dumps(analysis)
+        stored_hash = file_hash if doc_type != "Error" else None
+        try:
+            with db_connection(readonly=False) as db, db:
+                cursor = db.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('INSERT INTO documents (filename, file_hash) VALUES (?, ?)', (filename, stored_hash))
+                doc_id = cursor.lastrowid
+                cursor.execute(
+                    'INSERT INTO document_content (doc_id, content) VALUES (?, ?)',
+                    (doc_id, compress(text_content[:PROMPT_TEXT_LIMIT].encode()))
+                )
+
+                cursor.execute(
+                    'INSERT INTO analysis_results (doc_id, doc_type, confidence, missing_fields, recommendations, analysis_json, etag) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (doc_id, doc_type, confidence, orjson.dumps(missing_fields).decode(), orjson.dumps(recommendations).decode(),
+                     compress(analysis_json), analysis_etag(analysis_json))
+                )
+        except sqlite3.IntegrityError:
+            # The same file was stored by a concurrent upload in the meantime
+            existing = find_analyzed_document(file_hash)
+            if existing is None:
+                raise
+            return jsonify(existing), 200
+
+        # Archiving doesn't hold up the response
+        archive_executor.submit(archive_upload, pdf_bytes, filepath)
 
         return jsonify({
             "message": "File uploaded and analyzed successfully",
             "document_id": doc_id,
             "filename": filename,
             "classification": classification_result,
-            "analysis": {
-                "missing_fields": analysis_result.get("missing_fields", []),
-                "incomplete_fields": analysis_result.get("incomplete_fields", []),
-                "recommendations": analysis_result.get("recommendations", []),
-                "risk_factors": analysis_result.get("risk_factors", []),
-                "compliance_notes": analysis_result.get("compliance_notes", []),
-                "completeness_score": analysis_result.get("completeness_score", 0),
-                "critical_issues": analysis_result.get("critical_issues", [])
-            }
+            "analysis": analysis
         }), 201
     else:
         return jsonify({"error": "File type not allowed"}), 400
 
 @app.route('/analysis/<int:doc_id>', methods=['GET'])
 def get_analysis_result(doc_id):
-    db = get_db()
-    cursor = db.cursor()
     try:
-        # Get document metadata and content
-        cursor.execute(
-            'SELECT d.id, d.filename, d.content, r.doc_type, r.confidence '
-            'FROM documents d '
-            'LEFT JOIN analysis_results r ON d.id = r.doc_id '
-            'WHERE d.id = ?',
-            (doc_id,)
-        )
-        result = cursor.fetchone()
-        
+        refresh = request.args.get('refresh') == '1'
+
+        with db_connection() as db:
+            # A client holding the current version only needs the ETag checked
+            if not refresh and request.if_none_match:
+                stored = db.execute('SELECT etag FROM analysis_results WHERE doc_id = ?', (doc_id,)).fetchone()
+                if stored is not None and stored['etag'] and request.if_none_match.contains(stored['etag']):
+                    response = app.response_class(status=304)
+                    response.set_etag(stored['etag'])
+                    response.cache_control.no_cache = True
+                    return response
+
+            # Get document metadata and the stored analysis
+            result = db.execute(
+                'SELECT d.id, d.filename, r.doc_type, r.confidence, r.analysis_json, r.etag '
+                'FROM documents d '
+                'LEFT JOIN analysis_results r ON d.id = r.doc_id '
+                'WHERE d.id = ?',
+                (doc_id,)
+            ).fetchone()
+
         if result is None:
             return jsonify({"error": "Document not found"}), 404
 
-        # Get or re-analyze the document
+        # Return the analysis stored at upload time, re-analyzing only on ?refresh=1
         doc_type = result['doc_type'] or 'Unknown'
-        analysis_result = analyze_missing_fields(result['content'], doc_type)
+        classification = {"document_type": doc_type, "confidence_score": result['confidence'] or 0.0}
+        etag = result['etag']
+        reanalyzed = False
+        if result['analysis_json'] is not None and not refresh:
+            analysis_result = orjson.loads(decompress(result['analysis_json']))
+        else:
+            # The document text is only needed to re-analyze
+            with db_connection() as db:
+                content = db.execute('SELECT content FROM document_content WHERE doc_id = ?', (doc_id,)).fetchone()
+            text = decompress(content['content']).decode() if content else ''
+            if doc_type in REQUIRED_FIELDS:
+                analysis_result = analyze_missing_fields(text, doc_type, use_cache=not refresh)
+            else:
+                # Failed and unrecognised documents are classified again, as on upload
+                new_classification, analysis_result = classify_and_analyze(text, use_cache=not refresh)
+                if new_classification["document_type"] == "Error":
+                    analysis_result = None
+                else:
+                    classification = new_classification
+
+            # A failed re-analysis is reported but leaves the stored one in place
+            reanalyzed = analysis_result is not None
+            if not reanalyzed:
+                analysis_result = analysis_error()[1]
+                etag = None
 
         # Add error handlers for missing fields
         if not isinstance(analysis_result, dict):
@@ -327,10 +775,7 @@ def get_analysis_result(doc_id):
         response_data = {
             "document_id": result['id'],
             "filename": result['filename'],
-            "classification": {
-                "document_type": doc_type,
-                "confidence_score": result['confidence'] or 0.0
-            },
+            "classification": classification,
             "analysis": {
                 "missing_fields": analysis_result.get("missing_fields", []),
                 "incomplete_fields": analysis_result.get("incomplete_fields", []),
@@ -341,9 +786,30 @@ def get_analysis_result(doc_id):
                 "critical_issues": analysis_result.get("critical_issues", [])
             }
         }
-        
-        print("Sending response:", json.dumps(response_data, indent=2))
-        return jsonify(response_data), 200
+
+        if reanalyzed and result['doc_type'] is not None:
+            analysis = response_data["analysis"]
+            analysis_json = orjson.dumps(analysis)
+            etag = analysis_etag(analysis_json)
+            with db_connection(readonly=False) as db:
+                db.execute(
+                    'UPDATE analysis_results SET doc_type = ?, confidence = ?, missing_fields = ?, recommendations = ?, '
+                    'analysis_json = ?, etag = ?, analyzed_at = CURRENT_TIMESTAMP WHERE doc_id = ?',
+                    (classification["document_type"], classification["confidence_score"],
+                     orjson.dumps(analysis["missing_fields"]).decode(), orjson.dumps(analysis["recommendations"]).decode(),
+                     compress(analysis_json), etag, doc_id)
+                )
+
+        app.logger.debug("Sending analysis for document %s", doc_id)
+        response = jsonify(response_data)
+        # Clients revalidate with the ETag on every request, so a refresh by
+        # anyone is seen immediately. Refreshed responses carry no ETag.
+        if etag is not None and not refresh:
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+        return response, 200
+    except DatabaseBusyError:
+        raise
     except Exception as e:
         print(f"Error in /analysis endpoint: {e}")
         return jsonify({"error": f"Failed to retrieve analysis: {str(e)}"}), 500
@@ -1,17 +1,28 @@
 -- schema.sql
 
 -- Drop tables if they already exist to ensure a clean setup.
-DROP TABLE IF EXISTS documents;
+-- Tables referencing 'documents' go first, as foreign keys are enforced.
 DROP TABLE IF EXISTS analysis_results;
+DROP TABLE IF EXISTS document_content;
+DROP TABLE IF EXISTS documents;
+DROP TABLE IF EXISTS llm_cache;
 
--- Create the 'documents' table to store uploaded PDF content.
+-- Create the 'documents' table to store uploaded PDF metadata.
 CREATE TABLE documents (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   filename TEXT NOT NULL,
-  content TEXT NOT NULL,
+  file_hash TEXT UNIQUE, -- BLAKE2b digest of the uploaded file
   uploaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Create the 'document_content' table to store the extracted PDF text,
+-- kept apart so lookups on 'documents' don't page in large text values.
+CREATE TABLE document_content (
+  doc_id INTEGER PRIMARY KEY,
+  content BLOB NOT NULL, -- zstd-compressed UTF-8 text
+  FOREIGN KEY (doc_id) REFERENCES documents (id)
+);
+
 -- Create the 'analysis_results' table to store the output from the LLM.
 CREATE TABLE analysis_results (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -20,6 +31,19 @@ CREATE TABLE analysis_results (
   confidence REAL NOT NULL,
   missing_fields TEXT, -- Stored as a JSON string
   recommendations TEXT, -- Stored as a JSON string
+  analysis_json BLOB, -- Full analysis, stored as zstd-compressed JSON
+  etag TEXT, -- Hash of the uncompressed analysis JSON, for conditional GETs
   analyzed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY (doc_id) REFERENCES documents (id)
+);
+
+-- Index the join from documents to their analysis results; including the
+-- ETag lets conditional GETs be answered from the index alone.
+CREATE INDEX idx_results_doc_id ON analysis_results (doc_id, etag);
+
+-- Create the 'llm_cache' table to persist Gemini responses across restarts.
+CREATE TABLE llm_cache (
+  key TEXT PRIMARY KEY, -- Hash of the document text and the prompt name
+  response TEXT NOT NULL, -- Stored as a JSON string
+  created_at INTEGER NOT NULL -- Unix timestamp
 );
\ No newline at end of file